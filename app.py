@@ -1,27 +1,183 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
+import os
 import re
-from datetime import datetime
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Detalhe entries that are not exported
+UNWANTED_DETALHES = frozenset(['Transferência entre Disponíveis - Saída', 'Transferência entre Disponíveis - Entrada', 'Saldo Inicial'])
+
+# Characters not allowed in output file names
+UNSAFE_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*]')
+
+# Show the "module loaded" messages only on the first run of each session, not on every rerun
+show_module_info = not st.session_state.get('libs_checked', False)
+st.session_state['libs_checked'] = True
 
 # Attempt to import required modules
 fuzzy_available = False
 try:
-    from fuzzywuzzy import fuzz
+    from rapidfuzz import fuzz, process, utils
     fuzzy_available = True
-    st.info("Fuzzywuzzy module loaded successfully.")
+    if show_module_info:
+        st.info("Rapidfuzz module loaded successfully.")
+except ModuleNotFoundError:
+    st.warning("The 'rapidfuzz' module is not installed. Falling back to exact string matching for 'Detalhe' column. Ensure 'rapidfuzz' is in requirements.txt.")
+
+calamine_available = False
+try:
+    import python_calamine
+    calamine_available = True
+    if show_module_info:
+        st.info("Python-calamine module loaded successfully.")
 except ModuleNotFoundError:
-    st.warning("The 'fuzzywuzzy' module is not installed. Falling back to exact string matching for 'Detalhe' column. Ensure 'fuzzywuzzy' and 'python-Levenshtein' are in requirements.txt.")
+    st.warning("The 'python-calamine' module is not installed. Falling back to openpyxl for reading the Excel file. Ensure 'python-calamine' is in requirements.txt.")
 
 openpyxl_available = False
 try:
     from openpyxl import Workbook
-    from openpyxl.styles import numbers
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
     openpyxl_available = True
-    st.info("Openpyxl module loaded successfully.")
+    if show_module_info:
+        st.info("Openpyxl module loaded successfully.")
 except ModuleNotFoundError:
-    st.error("The 'openpyxl' module is not installed. Excel file generation will fail. Please ensure 'openpyxl' is included in your requirements.txt file.")
+    st.warning("The 'openpyxl' module is not installed. It is required to read or write Excel files when 'python-calamine' or 'xlsxwriter' is missing. Please ensure 'openpyxl' is included in your requirements.txt file.")
+
+xlsxwriter_available = False
+try:
+    import xlsxwriter
+    xlsxwriter_available = True
+    if show_module_info:
+        st.info("Xlsxwriter module loaded successfully.")
+except ModuleNotFoundError:
+    st.warning("The 'xlsxwriter' module is not installed. Falling back to openpyxl for Excel file generation. Ensure 'xlsxwriter' is in requirements.txt.")
+
+# Function to read both sheets from the uploaded file, using the Rust-based calamine reader when available.
+# Cached on the file contents so Streamlit reruns skip parsing the workbook again.
+@st.cache_data(show_spinner=False)
+def load_sheets(file_bytes):
+    # Both sheets are read from the same parsed workbook, which is closed as soon as they are loaded
+    with pd.ExcelFile(io.BytesIO(file_bytes), engine='calamine' if calamine_available else 'openpyxl') as excel_data:
+        base_df = pd.read_excel(excel_data, sheet_name='Planilha1', skiprows=8)
+        pagina1_df = pd.read_excel(excel_data, sheet_name='Página1', skiprows=4)
+    # Parse Column B (dates) once, here, instead of on every rerun; it is only replaced if every value
+    # is a date, otherwise to_dates keeps the unparseable values. read_excel already infers numeric columns
+    if len(base_df.columns) > 1:
+        dates = pd.to_datetime(base_df.iloc[:, 1], errors='coerce', format='mixed')
+        if dates.notna().sum() == base_df.iloc[:, 1].notna().sum():
+            base_df[base_df.columns[1]] = dates
+    return base_df, pagina1_df
+
+# Function to normalize a string for token_sort_ratio the way fuzzywuzzy did (full_process with force_ascii):
+# non-ASCII characters are dropped, so 'água' becomes 'gua', before lowercasing and keeping only alphanumerics
+def token_sort_process(text):
+    return utils.default_process(text.encode('ascii', 'ignore').decode('ascii'))
+
+# Function to clean the Página1 descriptions, keeping the originals aligned by position.
+# The category plan rarely changes between uploads, so the result is kept in memory as a shared resource.
+@st.cache_resource(show_spinner=False)
+def prepare_choices(pagina1_descriptions):
+    pagina1_descriptions = pagina1_descriptions.dropna()
+    originals = tuple(pagina1_descriptions.tolist())
+    choices = tuple(pagina1_descriptions.astype(str).str.split(' - ', n=1).str[-1].str.strip())
+    # token_sort_ratio compares normalized strings (ASCII, lowercase, alphanumeric only)
+    processed_choices = tuple(token_sort_process(choice) for choice in choices) if fuzzy_available else ()
+    # Lookup table for exact matches; the first Página1 entry wins. It is case-sensitive like partial_ratio
+    # when fuzzy matching is available, and case-insensitive for the exact-matching fallback
+    exact_index = {}
+    for original, choice in zip(originals, choices):
+        exact_index.setdefault(choice if fuzzy_available else choice.lower(), original)
+    return originals, choices, processed_choices, exact_index
+
+# Function to find the best match for every description in one pass.
+# Cached so Streamlit reruns (e.g. clicking a download button) skip the matching.
+@st.cache_data(show_spinner=False)
+def find_best_matches(descriptions, pagina1_descriptions):
+    matches = [None] * len(descriptions)
+    originals, choices, processed_choices, exact_index = prepare_choices(pagina1_descriptions)
+    if not choices:
+        return matches
+    # Strip all descriptions in one vectorized pass; the index is the position in descriptions.
+    # Only text values are matched, so non-string ones (even a fully numeric column) are blanked out first
+    clean_descriptions = pd.Series([desc if isinstance(desc, str) else None for desc in descriptions], dtype=object).str.strip().dropna()
+    # Most descriptions equal a Página1 entry verbatim, so exact matches are resolved with a hash lookup
+    # and only the misses are sent to fuzzy matching (or stay unmatched when it is unavailable).
+    # An exact hit wins even over an earlier Página1 entry that also scores 100, e.g. one containing the description
+    exact_matches = (clean_descriptions if fuzzy_available else clean_descriptions.str.lower()).map(exact_index)
+    is_exact = exact_matches.notna()
+    for i, original in exact_matches[is_exact].items():
+        matches[i] = original
+    clean_descriptions = clean_descriptions[~is_exact]
+    if not fuzzy_available or clean_descriptions.empty:
+        return matches
+    # Fuzzy matching: the scorer and threshold depend only on the description, so they are picked for all
+    # descriptions at once and each (scorer, threshold) group is scored in a single batch
+    lengths = clean_descriptions.str.len()
+    use_token_sort = (lengths > 20) | clean_descriptions.str.contains(',', regex=False)
+    thresholds = pd.Series(np.where(lengths < 20, 85, 75), index=clean_descriptions.index)
+    # Scores are stored as uint8 (0-100) to keep the queries x choices matrix small; like the integer scores
+    # of fuzzywuzzy they are rounded before the threshold check, so the exact score only needs threshold - 0.5
+    for (token_sort, threshold), queries in clean_descriptions.groupby([use_token_sort, thresholds]):
+        if token_sort:
+            # Long queries are normalized like processed_choices, so the scorer is called with processor=None
+            scores = process.cdist([token_sort_process(query) for query in queries], processed_choices, scorer=fuzz.token_sort_ratio, processor=None, score_cutoff=threshold - 0.5, dtype=np.uint8, workers=-1)
+        else:
+            scores = process.cdist(queries.tolist(), choices, scorer=fuzz.partial_ratio, score_cutoff=threshold - 0.5, dtype=np.uint8, workers=-1)
+        best = scores.argmax(axis=1)
+        found = scores[np.arange(len(queries)), best] >= threshold
+        for i, idx in zip(queries.index[found], best[found]):
+            matches[i] = originals[idx]
+    return matches
+
+# Function to write an output DataFrame to an in-memory .xlsx file
+def build_excel_buffer(output_df):
+    output_buffer = io.BytesIO()
+    rows = output_df.astype(object).where(output_df.notna(), None).itertuples(index=False, name=None)
+    if xlsxwriter_available:
+        # constant_memory flushes each row as soon as the next one is started, so rows are written
+        # in order here instead of through to_excel, which writes the sheet column by column
+        workbook = xlsxwriter.Workbook(output_buffer, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Dados')
+        # Columns A, B and C hold the DD/MM/YYYY dates
+        worksheet.set_column('A:C', 12, workbook.add_format({'num_format': 'DD/MM/YYYY'}))
+        worksheet.write_row(0, 0, output_df.columns, workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}))
+        for row_idx, row in enumerate(rows, 1):
+            worksheet.write_row(row_idx, 0, row)
+        workbook.close()
+    else:
+        # Stream the rows through a write-only workbook, so the sheet is never held in memory as cell objects
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Dados')
+        # Header in the same style as the xlsxwriter path (and to_excel): bold, thin border, centered at the top
+        thin = Side(style='thin')
+        header_cells = []
+        for column in output_df.columns:
+            cell = WriteOnlyCell(worksheet, value=column)
+            cell.font = Font(bold=True)
+            cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+            cell.alignment = Alignment(horizontal='center', vertical='top')
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+        # Columns A, B and C hold the DD/MM/YYYY dates; each row is serialized on append,
+        # so one pre-formatted cell per column can be reused for every row
+        date_cells = [WriteOnlyCell(worksheet) for _ in range(3)]
+        for cell in date_cells:
+            cell.number_format = 'DD/MM/YYYY'
+        for row in rows:
+            row = list(row)
+            for col, cell in enumerate(date_cells):
+                if row[col] is not None:
+                    cell.value = row[col]
+                    row[col] = cell
+            worksheet.append(row)
+        workbook.save(output_buffer)
+    output_buffer.seek(0)
+    return output_buffer
 
 st.title("Ajuste de Planilhas Conta Azul")
 st.markdown("Faça o upload do arquivo (`Economatos - planilha_Modelo_para_Importacao_do_Plano_de_categorias.xlsx`) para gerar os arquivos separados.")
@@ -30,47 +186,14 @@ st.markdown("Faça o upload do arquivo (`Economatos - planilha_Modelo_para_Impor
 uploaded_file = st.file_uploader("Selecione o arquivo de Excel", type=["xlsx"])
 
 if uploaded_file is not None:
-    if not openpyxl_available:
+    if not openpyxl_available and not (calamine_available and xlsxwriter_available):
         st.error("Cannot proceed without 'openpyxl'. Please install it and redeploy the app.")
         st.stop()
 
     try:
         with st.spinner("Calma.....Reza uma Ave Maria!"):
-            # Read the uploaded Excel file
-            excel_data = pd.ExcelFile(uploaded_file)
-
-            # Load the sheets
-            base_df = pd.read_excel(excel_data, sheet_name='Planilha1', skiprows=8)
-            pagina1_df = pd.read_excel(excel_data, sheet_name='Página1', skiprows=4)
-
-            # Function to find the best match
-            def find_best_match(description, pagina1_descriptions):
-                if pd.isna(description):
-                    return None
-                if not fuzzy_available:
-                    # Fallback to exact matching
-                    clean_description = description.strip()
-                    for pagina1_desc in pagina1_descriptions:
-                        if pd.isna(pagina1_desc):
-                            continue
-                        clean_pagina1_desc = pagina1_desc.split(' - ', 1)[-1].strip() if ' - ' in pagina1_desc else pagina1_desc.strip()
-                        if clean_description.lower() == clean_pagina1_desc.lower():
-                            return pagina1_desc
-                    return None
-                # Fuzzy matching
-                best_match = None
-                highest_score = 0
-                clean_description = description.strip()
-                for pagina1_desc in pagina1_descriptions:
-                    if pd.isna(pagina1_desc):
-                        continue
-                    clean_pagina1_desc = pagina1_desc.split(' - ', 1)[-1].strip() if ' - ' in pagina1_desc else pagina1_desc.strip()
-                    score = fuzz.token_sort_ratio(clean_description, clean_pagina1_desc) if len(clean_description) > 20 or ',' in clean_description else fuzz.partial_ratio(clean_description, clean_pagina1_desc)
-                    threshold = 85 if len(clean_description) < 20 else 75
-                    if score > highest_score and score >= threshold:
-                        highest_score = score
-                        best_match = pagina1_desc
-                return best_match
+            # Read the uploaded Excel file and load the sheets
+            base_df, pagina1_df = load_sheets(uploaded_file.getvalue())
 
             # Ensure 'Detalhe' column exists
             if 'Detalhe' not in base_df.columns:
@@ -84,39 +207,31 @@ if uploaded_file is not None:
             pagina1_descriptions = pagina1_df.iloc[:, 1]
 
             # Filter out unwanted entries
-            unwanted = ['Transferência entre Disponíveis - Saída', 'Transferência entre Disponíveis - Entrada', 'Saldo Inicial']
-            base_df = base_df[~base_df['Detalhe'].isin(unwanted)]
-
-            # Process the 'Detalhe' column
-            updated_descriptions = base_df['Detalhe'].copy()
-            for i in range(len(base_df)):
-                desc = base_df['Detalhe'].iloc[i]
-                best_match = find_best_match(desc, pagina1_descriptions)
-                if best_match:
-                    updated_descriptions.iloc[i] = best_match
-
-            # Update the 'Detalhe' column
-            base_df['Detalhe'] = updated_descriptions
-
-            # Function to format dates to DD/MM/YYYY
-            def format_date(value):
-                if pd.isna(value):
-                    return value
-                try:
-                    date_val = pd.to_datetime(value, errors='coerce')
-                    if pd.isna(date_val):
-                        return value
-                    return date_val.strftime('%d/%m/%Y')
-                except (ValueError, TypeError):
-                    return value
+            base_df = base_df.loc[~base_df['Detalhe'].isin(UNWANTED_DETALHES)]
+
+            # Process the 'Detalhe' column, matching each distinct description only once
+            unique_descriptions = base_df['Detalhe'].dropna().unique().tolist()
+            matches = find_best_matches(unique_descriptions, pagina1_descriptions)
+            mapping = {desc: match for desc, match in zip(unique_descriptions, matches) if match}
+            base_df['Detalhe'] = [mapping.get(desc, desc) for desc in base_df['Detalhe'].to_numpy()]
+
+            # Function to convert dates to native date values, keeping values that cannot be parsed as they are.
+            # The workbook shows them as DD/MM/YYYY through the column format, so Excel can still sort and filter them
+            def to_dates(values):
+                dates = pd.to_datetime(values, errors='coerce', format='mixed')
+                return dates.dt.date.where(dates.notna(), values)
 
             # Get unique values in Column C (index 2, Disponível)
             if len(base_df.columns) < 3:
                 st.error("Column C (Disponível) not found in Planilha1")
                 st.stop()
             
-            disponivel_column = base_df.iloc[:, 2].fillna('')
-            unique_disponiveis = disponivel_column[disponivel_column.str.strip() != ''].unique()
+            # Use Column C as a categorical, so the blank check only looks at the distinct values
+            # and the groupby below works on integer codes
+            disponivel_column = base_df.iloc[:, 2].astype('category')
+            blank_disponiveis = [value for value in disponivel_column.cat.categories if not str(value).strip()]
+            disponivel_column = disponivel_column.cat.remove_categories(blank_disponiveis)
+            unique_disponiveis = disponivel_column.dropna().unique()
             st.write("Detected unique Disponíveis:", list(unique_disponiveis))
 
             # Generate files for each unique Disponível
@@ -124,60 +239,68 @@ if uploaded_file is not None:
                 st.warning("No valid Disponível values found in Column C.")
                 st.stop()
 
-            for disponivel in sorted(unique_disponiveis):
-                filtered_df = base_df[base_df.iloc[:, 2].fillna('') == disponivel]
-                
-                if filtered_df.empty:
-                    st.warning(f"No data found for Disponível: {disponivel}, skipping file generation")
-                    continue
+            # Convert the date column (B) once, before the rows are split by Disponível
+            base_df[base_df.columns[1]] = to_dates(base_df.iloc[:, 1])
+
+            # Take the exported columns out as arrays once; each Disponível below only picks its rows from them
+            dates = base_df.iloc[:, 1].to_numpy()
+            valores = base_df.iloc[:, 9].to_numpy()
+            categorias = base_df.iloc[:, 3].to_numpy()
+            descricoes = base_df.iloc[:, 5].fillna(base_df['Detalhe']).to_numpy()
 
-                # Create output DataFrame
+            # Split the rows by Disponível in a single pass
+            output_files = []
+            used_file_names = set()
+            for disponivel, rows in base_df.groupby(disponivel_column, observed=True, sort=True).indices.items():
+                # Create output DataFrame; the three dates share the same source column
                 output_df = pd.DataFrame({
-                    'Data de Competência': filtered_df.iloc[:, 1],
-                    'Data de Vencimento': filtered_df.iloc[:, 1],
-                    'Data de Pagamento': filtered_df.iloc[:, 1],
-                    'Valor': filtered_df.iloc[:, 9],
-                    'Categoria': filtered_df.iloc[:, 3],
-                    'Descrição': filtered_df.apply(lambda row: row.iloc[5] if not pd.isna(row.iloc[5]) else row['Detalhe'], axis=1),
+                    'Data de Competência': dates[rows],
+                    'Data de Vencimento': dates[rows],
+                    'Data de Pagamento': dates[rows],
+                    'Valor': valores[rows],
+                    'Categoria': categorias[rows],
+                    'Descrição': descricoes[rows],
                     'Cliente/Fornecedor': None,
                     'CNPJ/CPF Cliente/Fornecedor': None,
                     'Centro de Custo': None,
                     'Observações': None
                 })
 
-                # Format dates
-                for col in ['Data de Competência', 'Data de Vencimento', 'Data de Pagamento']:
-                    output_df[col] = output_df[col].apply(format_date)
-
-                # Sanitize filename
-                safe_disponivel = re.sub(r'[<>:"/\\|?*]', '_', str(disponivel))
+                # Sanitize filename. Different Disponíveis can end up with the same name (e.g. 'Banco A/B' and 'Banco A_B',
+                # or 'Caixa' and 'caixa' on a case-insensitive file system), so a numbered suffix keeps every file in the ZIP
+                safe_disponivel = UNSAFE_FILENAME_CHARS.sub('_', str(disponivel))
                 output_file_name = f'{safe_disponivel}.xlsx'
+                suffix = 2
+                while output_file_name.casefold() in used_file_names:
+                    output_file_name = f'{safe_disponivel} ({suffix}).xlsx'
+                    suffix += 1
+                used_file_names.add(output_file_name.casefold())
+
+                output_files.append((disponivel, output_file_name, output_df))
+
+            # Save each file to a BytesIO buffer; the workbooks are independent, so they are written in parallel.
+            # Package all files into a single ZIP archive, so everything is fetched with one download.
+            # An .xlsx file is already a deflated ZIP container, so the files are stored without compressing them again
+            zip_buffer = io.BytesIO()
+            with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1, len(output_files))) as executor, \
+                    zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+                # Buffers are consumed as they finish, in order; each one is streamed into the archive from its
+                # own memory (no getvalue() copy) and released before the next one is taken
+                output_buffers = executor.map(build_excel_buffer, [output_df for _, _, output_df in output_files])
+                for (disponivel, output_file_name, _), output_buffer in zip(output_files, output_buffers):
+                    with zip_file.open(output_file_name, 'w') as zip_entry, output_buffer.getbuffer() as workbook_bytes:
+                        zip_entry.write(workbook_bytes)
+                    output_buffer.close()
+                    st.success(f"Arquivo pronto: {output_file_name} ({disponivel})")
+            zip_buffer.seek(0)
 
-                # Save to BytesIO buffer
-                output_buffer = io.BytesIO()
-                with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
-                    output_df.to_excel(writer, sheet_name='Dados', index=False)
-                    workbook = writer.book
-                    worksheet = writer.sheets['Dados']
-                    for col in ['A', 'B', 'C']:
-                        for row in range(2, len(output_df) + 2):
-                            cell = worksheet[f'{col}{row}']
-                            if cell.value and isinstance(cell.value, str) and '/' in cell.value:
-                                cell.number_format = 'DD/MM/YYYY'
-                            elif cell.value and isinstance(cell.value, (pd.Timestamp, datetime)):
-                                cell.value = cell.value.strftime('%d/%m/%Y')
-                                cell.number_format = 'DD/MM/YYYY'
-
-                output_buffer.seek(0)
-
-                # Provide download button
-                st.download_button(
-                    label=f"Download {output_file_name}",
-                    data=output_buffer,
-                    file_name=output_file_name,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
-                st.success(f"Arquivo pronto: {disponivel}")
+            # Provide download button
+            st.download_button(
+                label="Download resultado.zip",
+                data=zip_buffer,
+                file_name="resultado.zip",
+                mime="application/zip"
+            )
 
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")